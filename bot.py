@@ -1,14 +1,29 @@
 import os
+import sys
 import logging
+import logging.handlers
 import json
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-import pytz
+import hashlib
+import re
+import time
+import threading
+import atexit
+import queue
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from functools import lru_cache, partial
+from itertools import count
+from typing import Callable, Dict, List, Optional, Any, Set, Tuple, Union
 from dotenv import load_dotenv
 from telegram import (
     Update, 
     InlineKeyboardButton, 
     InlineKeyboardMarkup,
+    InputFile,
+    InputMediaPhoto,
+    InputMediaVideo,
     Message,
     Chat,
     Bot as TelegramBot,
@@ -20,10 +35,26 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
     Filters,
+    MessageFilter,
     CallbackContext,
-    ConversationHandler
+    ConversationHandler,
+    TypeHandler,
+    Defaults,
+    ExtBot
 )
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, TimedOut, NetworkError, BadRequest, Unauthorized
+from telegram.utils import request as ptb_request
+from telegram.utils.request import Request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Load environment variables
 load_dotenv()
@@ -35,11 +66,94 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# PTB's Request encodes/decodes Bot API payloads through its module-level
+# `json`; swap in orjson when it's installed
+if orjson is not None:
+    class _OrjsonCompat:
+        @staticmethod
+        def loads(s):
+            return orjson.loads(s)
+            
+        @staticmethod
+        def dumps(obj, **kwargs):
+            return orjson.dumps(obj).decode('utf-8')
+            
+    ptb_request.json = _OrjsonCompat
+
 # Bot configuration
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = json.loads(os.getenv('ADMIN_IDS', '[]'))
 DATABASE_URL = os.getenv('DATABASE_URL')
 
+# Webhook mode: Telegram pushes updates to WEBHOOK_URL/<BOT_TOKEN> instead of
+# the bot long-polling getUpdates. WEBHOOK_URL is the public HTTPS base URL
+# (usually a reverse proxy terminating TLS in front of PORT).
+USE_WEBHOOK = os.getenv('USE_WEBHOOK', '').lower() in ('1', 'true', 'yes')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+PORT = int(os.getenv('PORT', '8443'))
+
+# Optional self-hosted telegram-bot-api server, e.g. http://127.0.0.1:8081/bot
+# and http://127.0.0.1:8081/file/bot. Defaults to Telegram's public endpoints.
+BOT_API_URL = os.getenv('BOT_API_URL')
+BOT_API_FILE_URL = os.getenv('BOT_API_FILE_URL')
+# Set when that server runs with --local on this host. PTB always sends local
+# file paths as file:// URIs, which only such a server can read from disk;
+# otherwise the file contents are uploaded.
+BOT_API_LOCAL_MODE = os.getenv('BOT_API_LOCAL_MODE', '').lower() in ('1', 'true', 'yes')
+
+# Optional CPU list to pin the process to, Linux `taskset` syntax (e.g. "0-3"
+# for the cores of one NUMA node). Unset leaves scheduling to the OS.
+CPU_AFFINITY = os.getenv('CPU_AFFINITY')
+
+# Where the next getUpdates offset is kept between restarts (polling mode),
+# and the minimum seconds between writes to it
+OFFSET_FILE = os.getenv('OFFSET_FILE', '.offset')
+OFFSET_SAVE_INTERVAL = 1.0
+
+# Only the update types the handlers consume: commands, forwarded and text
+# messages, and inline keyboard callbacks
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Seconds a user's channel list is served from cache
+USER_CHANNELS_CACHE_TTL = 60
+
+# Telegram accepts at most 10 items per media group
+MEDIA_GROUP_MAX = 10
+
+# Seconds of inactivity before a post preview is sent
+PREVIEW_DEBOUNCE = 0.5
+
+# Sent posts kept in memory; the oldest are evicted first
+POSTS_MAX = 10_000
+
+# Uploaded media file ids remembered for re-sending without re-uploading
+FILE_IDS_MAX = 4096
+
+# Dispatcher worker threads running handlers
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', min(32, 4 * (os.cpu_count() or 1))))
+
+# Cap on channel-bot sends (posts and replies) in flight at once
+MAX_INFLIGHT_SENDS = int(os.getenv('MAX_INFLIGHT_SENDS', 16))
+
+# Threads dedicated to sending channel replies
+REPLY_SEND_WORKERS = 8
+
+# Outbound message rates (per second) kept under Telegram's limits
+GLOBAL_SEND_RATE = 28
+CHAT_SEND_RATE = 1
+
+# Retries for transient Bot API failures: exponential backoff 0.5s, 1s, 2s, 4s, 8s
+SEND_RETRIES = 5
+SEND_BACKOFF_BASE = 0.5
+SEND_BACKOFF_MAX = 8
+
+# Keep-alive connection pool shared by each Bot's requests to api.telegram.org
+REQUEST_KWARGS = {
+    'con_pool_size': 64,
+    'connect_timeout': 5,
+    'read_timeout': 20,
+}
+
 # Conversation states
 (
     SELECTING_ACTION,
@@ -55,33 +169,289 @@ DATABASE_URL = os.getenv('DATABASE_URL')
 ) = range(10)
 
 # Database models (simplified - in production use SQLAlchemy or similar)
+@dataclass(slots=True)
+class UserRecord:
+    id: int
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    language: str = 'en'
+
+@dataclass(slots=True)
+class ChannelRecord:
+    id: int
+    name: str
+    username: Optional[str]
+    type: str
+    admins: Set[int]
+    owner_id: int
+    added_date: str
+    bot_token: Optional[str] = None
+    timezone: str = 'UTC'
+
+@dataclass(slots=True)
+class PostRecord:
+    id: str
+    channel_id: int
+    user_id: int
+    messages: List[Dict]
+    sent_messages: List[int] = field(default_factory=list)
+    sent_date: Optional[str] = None
+    type: str = 'instant'
+
 class Database:
     def __init__(self):
-        self.users = {}
-        self.channels = {}
-        self.posts = {}
+        self.users: Dict[int, UserRecord] = {}
+        self.channels: Dict[int, ChannelRecord] = {}
+        self.posts: 'OrderedDict[str, PostRecord]' = OrderedDict()
         self.scheduled_posts = {}
         self.bots = {}
         self.subscriptions = {}
         
-    def save_user(self, user_id: int, data: Dict):
+        # Secondary indexes: user id -> ids of channels they admin / own
+        self.user_channels: Dict[int, Set[int]] = {}
+        self.owner_channels: Dict[int, Set[int]] = {}
+        
+        # Short-lived get_user_channels results: user id -> (timestamp, channels)
+        self._user_channels_cache: Dict[int, Tuple[float, List[ChannelRecord]]] = {}
+        
+        # Telegram file ids of media uploaded from raw bytes/paths, keyed by
+        # (bot token, content key); file ids are only valid for the bot that got them
+        self.file_ids: 'OrderedDict[Tuple[str, str], str]' = OrderedDict()
+        
+        # Handlers run on the dispatcher's worker threads; guards the channel indexes
+        self._lock = threading.RLock()
+        
+    def save_user(self, user_id: int, data: Union[UserRecord, Dict]):
+        if isinstance(data, dict):
+            data = UserRecord(**data)
         self.users[user_id] = data
         
-    def get_user(self, user_id: int) -> Optional[Dict]:
+    def get_user(self, user_id: int) -> Optional[UserRecord]:
         return self.users.get(user_id)
         
-    def save_channel(self, channel_id: int, data: Dict):
-        self.channels[channel_id] = data
+    def save_post(self, post_id: str, data: PostRecord):
+        with self._lock:
+            if post_id not in self.posts and len(self.posts) >= POSTS_MAX:
+                self.posts.popitem(last=False)
+            self.posts[post_id] = data
+            self.posts.move_to_end(post_id)
         
-    def get_channel(self, channel_id: int) -> Optional[Dict]:
+    def get_post(self, post_id: str) -> Optional[PostRecord]:
+        return self.posts.get(post_id)
+        
+    def save_file_id(self, bot_token: str, media_key: str, file_id: str):
+        with self._lock:
+            key = (bot_token, media_key)
+            if key not in self.file_ids and len(self.file_ids) >= FILE_IDS_MAX:
+                self.file_ids.popitem(last=False)
+            self.file_ids[key] = file_id
+            self.file_ids.move_to_end(key)
+        
+    def get_file_id(self, bot_token: str, media_key: str) -> Optional[str]:
+        return self.file_ids.get((bot_token, media_key))
+        
+    def save_channel(self, channel_id: int, data: Union[ChannelRecord, Dict]):
+        if isinstance(data, dict):
+            data = ChannelRecord(**data)
+        if not isinstance(data.admins, set):
+            data.admins = set(data.admins)
+        with self._lock:
+            old = self.channels.get(channel_id)
+            old_admins = old.admins if old else set()
+            new_admins = data.admins
+            self._reindex(self.user_channels, channel_id, old_admins, new_admins)
+            self._reindex(self.owner_channels, channel_id,
+                          {old.owner_id} if old else set(), {data.owner_id})
+            self._invalidate_user_channels(old_admins | new_admins)
+            self.channels[channel_id] = data
+        
+    def remove_channel(self, channel_id: int) -> Optional[ChannelRecord]:
+        with self._lock:
+            data = self.channels.pop(channel_id, None)
+            if data is not None:
+                self._reindex(self.user_channels, channel_id, data.admins, set())
+                self._reindex(self.owner_channels, channel_id, {data.owner_id}, set())
+                self._invalidate_user_channels(data.admins)
+        return data
+        
+    @staticmethod
+    def _reindex(index: Dict[int, Set[int]], channel_id: int, old_ids: Set[int], new_ids: Set[int]):
+        """Move channel_id between per-user index buckets."""
+        for uid in old_ids - new_ids:
+            bucket = index.get(uid)
+            if bucket is not None:
+                bucket.discard(channel_id)
+                if not bucket:
+                    del index[uid]
+        for uid in new_ids - old_ids:
+            index.setdefault(uid, set()).add(channel_id)
+        
+    def get_channel(self, channel_id: int) -> Optional[ChannelRecord]:
         return self.channels.get(channel_id)
         
-    def get_user_channels(self, user_id: int) -> List[Dict]:
-        return [c for c in self.channels.values() if user_id in c.get('admins', [])]
+    def _invalidate_user_channels(self, user_ids):
+        for uid in user_ids:
+            self._user_channels_cache.pop(uid, None)
+        
+    def get_user_channels(self, user_id: int) -> List[ChannelRecord]:
+        now = time.monotonic()
+        cached = self._user_channels_cache.get(user_id)
+        if cached and now - cached[0] < USER_CHANNELS_CACHE_TTL:
+            return cached[1]
+        with self._lock:
+            channels = [self.channels[cid] for cid in self.user_channels.get(user_id, ())]
+            self._user_channels_cache[user_id] = (now, channels)
+        return channels
+        
+    def get_owner_channels(self, user_id: int) -> List[ChannelRecord]:
+        with self._lock:
+            return [self.channels[cid] for cid in self.owner_channels.get(user_id, ())]
 
 # Initialize database
 db = Database()
 
+# Sequence for unique post ids within this process
+_post_seq = count()
+
+class TokenBucket:
+    """Thread-safe token bucket; consume() blocks until a token is available."""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        
+    def consume(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+# Outbound Bot API writes stay under Telegram's ~30 msg/s per bot token and
+# ~1 msg/s per chat limits instead of tripping FloodWait
+_global_buckets: Dict[str, TokenBucket] = defaultdict(
+    lambda: TokenBucket(rate=GLOBAL_SEND_RATE, capacity=GLOBAL_SEND_RATE)
+)
+_chat_buckets: Dict[int, TokenBucket] = defaultdict(
+    lambda: TokenBucket(rate=CHAT_SEND_RATE, capacity=CHAT_SEND_RATE)
+)
+_buckets_lock = threading.Lock()
+
+# Bot API methods that count against the message limits
+_MESSAGE_METHOD_PREFIXES = ('send', 'edit', 'copy', 'forward')
+
+_inflight_sends = threading.BoundedSemaphore(MAX_INFLIGHT_SENDS)
+
+def _throttle(token: str, chat_id: Optional[int] = None):
+    """Block until both the bot's global and the chat's send budget allow one more message."""
+    with _buckets_lock:
+        bucket = _global_buckets[token]
+        chat_bucket = _chat_buckets[chat_id] if chat_id is not None else None
+    bucket.consume()
+    if chat_bucket is not None:
+        chat_bucket.consume()
+
+def _gated_send(send, **kwargs):
+    """Call a Bot API send method once the rate limits and the in-flight cap allow it."""
+    # `send` is a bound Bot method, possibly wrapped in a partial
+    token = getattr(send, 'func', send).__self__.token
+    _throttle(token, kwargs.get('chat_id'))
+    with _inflight_sends:
+        return send(**kwargs)
+
+class _ThrottledRequest(Request):
+    """Request for the controller bot; its message calls spend from the token's global budget."""
+    
+    __slots__ = ('_token',)
+    
+    def __init__(self, token: str, **kwargs):
+        super().__init__(**kwargs)
+        self._token = token
+        
+    def post(self, url: str, data: Dict, timeout: float = None):
+        if url.rsplit('/', 1)[-1].startswith(_MESSAGE_METHOD_PREFIXES):
+            _throttle(self._token)
+        return super().post(url, data, timeout=timeout)
+
+@lru_cache(maxsize=256)
+def _bot_for(token: str) -> TelegramBot:
+    """Get a shared Bot for a channel token so sends reuse its connection pool."""
+    return TelegramBot(
+        token=token,
+        base_url=BOT_API_URL,
+        base_file_url=BOT_API_FILE_URL,
+        request=Request(**REQUEST_KWARGS)
+    )
+
+def _send_with_retry(send, **kwargs):
+    """Call a Bot API send method, waiting out flood limits and retrying transient network errors.
+    
+    BadRequest/Unauthorized are raised immediately since resending the same
+    request can't succeed.
+    """
+    attempt = 0
+    flood_retried = False
+    while True:
+        try:
+            return _gated_send(send, **kwargs)
+        except RetryAfter as e:
+            if flood_retried:
+                raise
+            flood_retried = True
+            logger.warning("Flood limit hit, retrying in %s s", e.retry_after)
+            time.sleep(e.retry_after + 0.1)
+        except (BadRequest, Unauthorized):
+            raise
+        except (TimedOut, NetworkError) as e:
+            attempt += 1
+            if attempt > SEND_RETRIES:
+                raise
+            delay = min(SEND_BACKOFF_BASE * 2 ** (attempt - 1), SEND_BACKOFF_MAX)
+            logger.warning("Send failed (%s), retrying in %.1f s", e, delay)
+            time.sleep(delay)
+
+def _media_key(media: Any) -> Optional[str]:
+    """Content key for raw media (bytes or a local file path).
+    
+    Returns None for anything else, e.g. file ids and URLs, which Telegram
+    resolves without an upload anyway.
+    """
+    if isinstance(media, (bytes, bytearray)):
+        size = len(media)
+        head, tail = bytes(media[:65536]), bytes(media[-65536:])
+    elif isinstance(media, str) and os.path.isfile(media):
+        size = os.path.getsize(media)
+        with open(media, 'rb') as f:
+            head = f.read(65536)
+            f.seek(max(size - 65536, 0))
+            tail = f.read()
+    else:
+        return None
+    return hashlib.blake2b(head + tail + size.to_bytes(8, 'little')).hexdigest()
+
+def _upload_input(media: Any) -> Any:
+    """Media argument for a send call; local paths are uploaded unless the local server can read them.
+    
+    InputFile reads the file up front and keeps its basename, so documents
+    and videos arrive with their real name and MIME type.
+    """
+    if not BOT_API_LOCAL_MODE and isinstance(media, str) and os.path.isfile(media):
+        with open(media, 'rb') as f:
+            return InputFile(f, attach=True)
+    return media
+
+def _internal_chat_id(chat_id: int) -> int:
+    """Strip the -100 prefix of a channel/supergroup id for t.me/c/ links."""
+    return -chat_id - 10**12 if chat_id < 0 else chat_id
+
 # Language strings (simplified version from your config)
 LANG = {
     'start': """
@@ -103,17 +473,183 @@ To add a channel you should follow these two steps:
 1. Add the bot to admins of your channel.
 2. Then forward to me any message from your channel (you can also send me its username or ID).
 """,
-        'added': "Success! The channel has been added."
-    }
+        'added': "Success! The channel has been added.",
+        'added_details': """
+✅ <b>Channel Added Successfully!</b>
+
+<b>Channel:</b> {title}
+<b>Username:</b> @{username}
+<b>Type:</b> {type}
+
+Now you can:
+1. Go to @{bot_username} to create posts
+2. Add more admins in channel settings
+3. Set up timezone for scheduling
+
+<code>/newpost</code> - Create your first post
+<code>/mychannels</code> - Manage your channels
+"""
+    },
+    'posts': {
+        'sent': """
+✅ <b>Post Successfully Sent!</b>
+
+<b>Channel:</b> {channel}
+<b>Messages:</b> {count}
+<b>Time:</b> {time}
+
+You can now reply to this post directly in the channel.
+"""
+    },
+    'help': """
+<b>Controller Bot Help</b>
+
+I can help you manage Telegram channels with these features:
+
+📝 <b>Create Posts</b> - Create formatted posts with markdown/HTML
+🔄 <b>Edit Posts</b> - Edit existing posts in your channels
+⏰ <b>Schedule Posts</b> - Schedule posts for later delivery
+📊 <b>View Statistics</b> - Get channel analytics
+💰 <b>Paid Subscriptions</b> - Manage paid channel subscriptions
+⚙️ <b>Channel Management</b> - Add/remove channels and bots
+
+<b>Available Commands:</b>
+/start - Main menu
+/newpost - Create new post
+/addchannel - Add new channel
+/mychannels - Manage your channels
+/settings - Bot settings
+/lang - Change language
+
+For detailed help, visit our <a href="https://telegra.ph/Controller-Help-03-20">Help Page</a>
+"""
 }
 
+# Users currently composing a post; mirrors user_data['creating_post'] so
+# idle text messages are rejected by the filter before reaching a handler
+_creating_post_users: Set[int] = set()
+
+class _CreatingPostFilter(MessageFilter):
+    def filter(self, message: Message) -> bool:
+        return message.from_user is not None and message.from_user.id in _creating_post_users
+
+# Callback data carrying an argument, e.g. `select_channel_-100123`
+_CALLBACK_RE = re.compile(r'^(?P<op>select_channel|lang)_(?P<arg>.+)$')
+
+# Static keyboards, built once and shared across updates
+_BACK_BTN = InlineKeyboardButton("« Back", callback_data="back_to_main")
+_BACK_ONLY_MARKUP = InlineKeyboardMarkup([[_BACK_BTN]])
+
+_MAIN_MENU_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Create Post", callback_data="create_post")],
+    [InlineKeyboardButton("📢 My Channels", callback_data="my_channels")],
+    [InlineKeyboardButton("⏰ Scheduled Posts", callback_data="scheduled_posts")],
+    [InlineKeyboardButton("📊 Statistics", callback_data="statistics")],
+    [InlineKeyboardButton("⚙️ Settings", callback_data="settings")],
+    [InlineKeyboardButton("❓ Help", callback_data="help")]
+])
+
+_POST_CREATE_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📎 Add Media", callback_data="add_media"),
+        InlineKeyboardButton("🔗 Add Buttons", callback_data="add_buttons")
+    ],
+    [
+        InlineKeyboardButton("👀 Preview", callback_data="post_preview"),
+        InlineKeyboardButton("🗑 Clear All", callback_data="clear_post")
+    ],
+    [
+        InlineKeyboardButton("⏰ Schedule", callback_data="schedule_post"),
+        InlineKeyboardButton("📤 Send Now", callback_data="send_post")
+    ],
+    [InlineKeyboardButton("« Cancel", callback_data="back_to_main")]
+])
+
+_LANGUAGE_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🇬🇧 English", callback_data="lang_en"),
+        InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru")
+    ],
+    [_BACK_BTN]
+])
+
+_SCHEDULE_KB = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Today 09:00", callback_data="schedule_today_0900"),
+        InlineKeyboardButton("Today 18:00", callback_data="schedule_today_1800")
+    ],
+    [
+        InlineKeyboardButton("Tomorrow 09:00", callback_data="schedule_tomorrow_0900"),
+        InlineKeyboardButton("Tomorrow 18:00", callback_data="schedule_tomorrow_1800")
+    ],
+    [InlineKeyboardButton("« Back", callback_data="post_preview")]
+])
+
 class TelegramChannelBot:
     def __init__(self, token: str):
-        self.updater = Updater(token, use_context=True)
+        # Handlers run on the dispatcher's worker pool by default so one slow
+        # Bot API call doesn't hold up every other user's updates
+        self.updater = Updater(
+            bot=ExtBot(
+                token,
+                base_url=BOT_API_URL,
+                base_file_url=BOT_API_FILE_URL,
+                request=_ThrottledRequest(token, **REQUEST_KWARGS),
+                defaults=Defaults(run_async=True)
+            ),
+            use_context=True,
+            workers=BOT_WORKERS
+        )
         self.dispatcher = self.updater.dispatcher
         self.bot = self.updater.bot
+        
+        # Callback dispatch: exact callback_data, then `<op>_<arg>` prefixes
+        self._callback_handlers = {
+            'back_to_main': self._cb_back_to_main,
+            'post_preview': self._cb_post_preview,
+            'send_post': self.send_post_to_channel,
+            'schedule_post': self.schedule_post,
+        }
+        self._callback_arg_handlers = {
+            'select_channel': self._cb_select_channel,
+            'lang': self._cb_lang,
+        }
+        
+        # Next update_id to fetch, and when it was last written to OFFSET_FILE
+        self._offset: Optional[int] = None
+        self._offset_saved_at = 0.0
+        
         self.setup_handlers()
         
+    def load_offset(self):
+        """Resume polling after the last update handled by a previous run."""
+        try:
+            with open(OFFSET_FILE) as f:
+                self.updater.last_update_id = int(f.read().strip())
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable offset file %s: %s", OFFSET_FILE, e)
+            
+    def save_offset(self):
+        if self._offset is None:
+            return
+        # Stamp first so a failing disk is retried once per interval, not per update
+        self._offset_saved_at = time.monotonic()
+        tmp_path = f"{OFFSET_FILE}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(str(self._offset))
+            os.replace(tmp_path, OFFSET_FILE)
+        except OSError as e:
+            logger.warning("Could not save offset file %s: %s", OFFSET_FILE, e)
+        
+    def record_offset(self, update: Update, context: CallbackContext):
+        """Track the processed update_id, writing it out at most every OFFSET_SAVE_INTERVAL."""
+        self._offset = update.update_id + 1
+        if time.monotonic() - self._offset_saved_at >= OFFSET_SAVE_INTERVAL:
+            self.save_offset()
+            
     def setup_handlers(self):
         """Setup all command and message handlers"""
         
@@ -133,13 +669,20 @@ class TelegramChannelBot:
         ))
         
         self.dispatcher.add_handler(MessageHandler(
-            Filters.text & ~Filters.command,
-            self.handle_text_message
+            Filters.text & ~Filters.command & _CreatingPostFilter(),
+            self.handle_text_message,
+            # Messages must be appended to the post in the order they arrive
+            run_async=False
         ))
         
         # Callback query handlers
         self.dispatcher.add_handler(CallbackQueryHandler(self.handle_callback))
         
+        # Runs in its own group after the handlers above have been dispatched;
+        # only polling resumes from a stored offset
+        if not USE_WEBHOOK:
+            self.dispatcher.add_handler(TypeHandler(Update, self.record_offset, run_async=False), group=1)
+        
         # Error handler
         self.dispatcher.add_error_handler(self.error_handler)
         
@@ -148,11 +691,9 @@ class TelegramChannelBot:
         user = update.effective_user
         
         # Initialize user data
-        user_data = db.get_user(user.id) or {}
-        user_data['id'] = user.id
-        user_data['username'] = user.username
-        user_data['first_name'] = user.first_name
-        user_data['language'] = user_data.get('language', 'en')
+        user_data = db.get_user(user.id) or UserRecord(id=user.id)
+        user_data.username = user.username
+        user_data.first_name = user.first_name
         db.save_user(user.id, user_data)
         
         # Send welcome message with preserved formatting
@@ -166,31 +707,8 @@ class TelegramChannelBot:
         
     def help_command(self, update: Update, context: CallbackContext):
         """Send help message."""
-        help_text = """
-<b>Controller Bot Help</b>
-
-I can help you manage Telegram channels with these features:
-
-📝 <b>Create Posts</b> - Create formatted posts with markdown/HTML
-🔄 <b>Edit Posts</b> - Edit existing posts in your channels
-⏰ <b>Schedule Posts</b> - Schedule posts for later delivery
-📊 <b>View Statistics</b> - Get channel analytics
-💰 <b>Paid Subscriptions</b> - Manage paid channel subscriptions
-⚙️ <b>Channel Management</b> - Add/remove channels and bots
-
-<b>Available Commands:</b>
-/start - Main menu
-/newpost - Create new post
-/addchannel - Add new channel
-/mychannels - Manage your channels
-/settings - Bot settings
-/lang - Change language
-
-For detailed help, visit our <a href="https://telegra.ph/Controller-Help-03-20">Help Page</a>
-        """
-        
         update.message.reply_text(
-            help_text,
+            LANG['help'],
             parse_mode=ParseMode.HTML,
             disable_web_page_preview=False
         )
@@ -202,32 +720,24 @@ For detailed help, visit our <a href="https://telegra.ph/Controller-Help-03-20">
         
         if not user_channels:
             update.message.reply_text(
-                "There is no added channels yet.\n\nSend /addchannel to add a new one.",
-                parse_mode=ParseMode.HTML
+                "There is no added channels yet.\n\nSend /addchannel to add a new one."
             )
             return ConversationHandler.END
             
         # Show channel selection
-        keyboard = []
-        for channel in user_channels:
-            channel_name = channel.get('name', 'Unknown Channel')
-            if channel.get('username'):
-                channel_name += f" (@{channel['username']})"
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"📢 {channel_name}",
-                    callback_data=f"select_channel_{channel['id']}"
-                )
-            ])
-            
-        keyboard.append([
-            InlineKeyboardButton("« Back", callback_data="back_to_main")
-        ])
+        keyboard = [
+            [InlineKeyboardButton(
+                f"📢 {channel.name or 'Unknown Channel'}"
+                f"{' (@' + channel.username + ')' if channel.username else ''}",
+                callback_data=f"select_channel_{channel.id}"
+            )]
+            for channel in user_channels
+        ]
+        keyboard.append([_BACK_BTN])
         
         update.message.reply_text(
             "Choose a channel to create a new post:",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.HTML
+            reply_markup=InlineKeyboardMarkup(keyboard)
         )
         
         return SELECTING_CHANNEL
@@ -237,9 +747,7 @@ For detailed help, visit our <a href="https://telegra.ph/Controller-Help-03-20">
         update.message.reply_text(
             LANG['channels']['add'],
             parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("« Back", callback_data="back_to_main")]
-            ])
+            reply_markup=_BACK_ONLY_MARKUP
         )
         
         return TYPING_CHANNEL
@@ -251,27 +759,19 @@ For detailed help, visit our <a href="https://telegra.ph/Controller-Help-03-20">
         
         if not user_channels:
             update.message.reply_text(
-                "You don't have any channels yet. Use /addchannel to add one.",
-                parse_mode=ParseMode.HTML
+                "You don't have any channels yet. Use /addchannel to add one."
             )
             return
             
         # Create channel list with management options
-        keyboard = []
-        for channel in user_channels:
-            channel_name = channel.get('name', 'Unknown')
-            channel_id = channel['id']
-            
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"📢 {channel_name}",
-                    callback_data=f"manage_channel_{channel_id}"
-                )
-            ])
-            
-        keyboard.append([
-            InlineKeyboardButton("« Back", callback_data="back_to_main")
-        ])
+        keyboard = [
+            [InlineKeyboardButton(
+                f"📢 {channel.name or 'Unknown'}",
+                callback_data=f"manage_channel_{channel.id}"
+            )]
+            for channel in user_channels
+        ]
+        keyboard.append([_BACK_BTN])
         
         update.message.reply_text(
             f"📋 <b>Your Channels</b>\n\nYou have {len(user_channels)} channel(s). Select one to manage:",
@@ -285,7 +785,7 @@ For detailed help, visit our <a href="https://telegra.ph/Controller-Help-03-20">
             [InlineKeyboardButton("🌐 Change Language", callback_data="change_language")],
             [InlineKeyboardButton("🤖 Manage Bots", callback_data="manage_bots")],
             [InlineKeyboardButton("⚙️ Post Settings", callback_data="post_settings")],
-            [InlineKeyboardButton("« Back", callback_data="back_to_main")]
+            [_BACK_BTN]
         ]
         
         update.message.reply_text(
@@ -296,17 +796,9 @@ For detailed help, visit our <a href="https://telegra.ph/Controller-Help-03-20">
         
     def change_language(self, update: Update, context: CallbackContext):
         """Change bot language."""
-        keyboard = [
-            [
-                InlineKeyboardButton("🇬🇧 English", callback_data="lang_en"),
-                InlineKeyboardButton("🇷🇺 Русский", callback_data="lang_ru")
-            ],
-            [InlineKeyboardButton("« Back", callback_data="back_to_main")]
-        ]
-        
         update.message.reply_text(
             "Please choose your language:",
-            reply_markup=InlineKeyboardMarkup(keyboard)
+            reply_markup=_LANGUAGE_KB
         )
         
     def handle_forwarded_message(self, update: Update, context: CallbackContext):
@@ -327,48 +819,40 @@ For detailed help, visit our <a href="https://telegra.ph/Controller-Help-03-20">
                 chat_member = context.bot.get_chat_member(chat.id, user.id)
                 if chat_member.status not in ['creator', 'administrator']:
                     update.message.reply_text(
-                        "You aren't an administrator in this channel.",
-                        parse_mode=ParseMode.HTML
+                        "You aren't an administrator in this channel."
                     )
                     return
             except TelegramError:
                 update.message.reply_text(
-                    "Unable to verify your admin status. Please make sure the bot is added as admin.",
-                    parse_mode=ParseMode.HTML
+                    "Unable to verify your admin status. Please make sure the bot is added as admin."
                 )
                 return
                 
             # Save channel to database
-            channel_data = {
-                'id': chat.id,
-                'name': chat.title,
-                'username': chat.username,
-                'type': chat.type,
-                'admins': [user.id],
-                'owner_id': user.id,
-                'added_date': datetime.now().isoformat(),
-                'bot_token': None,
-                'timezone': 'UTC'
-            }
+            channel_data = ChannelRecord(
+                id=chat.id,
+                name=chat.title,
+                username=chat.username,
+                type=chat.type,
+                admins={user.id},
+                owner_id=user.id,
+                added_date=datetime.now().isoformat(),
+                bot_token=None,
+                timezone='UTC'
+            )
             
             db.save_channel(chat.id, channel_data)
             
             # Send success message
-            success_msg = f"""
-✅ <b>Channel Added Successfully!</b>
-
-<b>Channel:</b> {chat.title}
-<b>Username:</b> @{chat.username if chat.username else 'Private'}
-<b>Type:</b> {chat.type.capitalize()}
-
-Now you can:
-1. Go to @{context.bot.username} to create posts
-2. Add more admins in channel settings
-3. Set up timezone for scheduling
-
-<code>/newpost</code> - Create your first post
-<code>/mychannels</code> - Manage your channels
-            """
+            username = chat.username or 'Private'
+            chat_type = chat.type.capitalize()
+            bot_username = context.bot.username
+            success_msg = LANG['channels']['added_details'].format(
+                title=chat.title,
+                username=username,
+                type=chat_type,
+                bot_username=bot_username
+            )
             
             update.message.reply_text(
                 success_msg,
@@ -397,88 +881,98 @@ Now you can:
             if 'post_messages' not in context.user_data:
                 context.user_data['post_messages'] = []
                 
-            # Preserve all formatting
+            # Preserve all formatting; text_html re-renders entities on every
+            # access, so evaluate it once
+            text_html = message.text_html
             message_data = {
-                'text': message.text_html if message.text_html else message.text_markdown,
-                'parse_mode': 'HTML' if message.text_html else 'Markdown',
+                'text': text_html if text_html else message.text_markdown,
+                'parse_mode': 'HTML' if text_html else 'Markdown',
                 'entities': message.entities,
                 'message_id': message.message_id,
                 'date': datetime.now().isoformat()
             }
             
             # Check for media
+            has_media = True
             if message.photo:
                 message_data['photo'] = message.photo[-1].file_id
-                message_data['caption'] = message.caption_html if message.caption_html else message.caption
-                message_data['caption_entities'] = message.caption_entities
             elif message.video:
                 message_data['video'] = message.video.file_id
-                message_data['caption'] = message.caption_html if message.caption_html else message.caption
-                message_data['caption_entities'] = message.caption_entities
             elif message.document:
                 message_data['document'] = message.document.file_id
-                message_data['caption'] = message.caption_html if message.caption_html else message.caption
+            else:
+                has_media = False
+                
+            if has_media:
+                caption_html = message.caption_html
+                message_data['caption'] = caption_html if caption_html else message.caption
                 message_data['caption_entities'] = message.caption_entities
                 
             context.user_data['post_messages'].append(message_data)
             
-            # Show post preview
-            self.show_post_preview(update, context)
+            # Show post preview once the user stops sending for a moment
+            self.schedule_post_preview(update, context)
             
     def handle_callback(self, update: Update, context: CallbackContext):
         """Handle inline keyboard callbacks."""
         query = update.callback_query
-        user = update.effective_user
         
         # Answer callback query
         query.answer()
         
         data = query.data
         
-        if data == 'back_to_main':
-            self.show_main_menu(query)
-            
-        elif data.startswith('select_channel_'):
-            channel_id = int(data.split('_')[-1])
-            context.user_data['selected_channel'] = channel_id
-            context.user_data['creating_post'] = True
+        # Any other callback may edit the preview message into something else
+        if data != 'post_preview':
+            context.user_data.pop('_last_preview', None)
             
-            channel = db.get_channel(channel_id)
-            if channel:
-                query.edit_message_text(
-                    f"📝 <b>Creating post for:</b> {channel['name']}\n\n"
-                    "Send me the content for your post. You can send:\n"
-                    "• Text with formatting\n"
-                    "• Photos with captions\n"
-                    "• Videos with captions\n"
-                    "• Documents\n\n"
-                    "When finished, click 'Preview' below.",
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=self.get_post_creation_keyboard()
-                )
-                
-        elif data == 'post_preview':
-            self.show_post_preview(update, context, is_callback=True)
-            
-        elif data == 'send_post':
-            self.send_post_to_channel(update, context)
-            
-        elif data == 'schedule_post':
-            self.schedule_post(update, context)
+        handler = self._callback_handlers.get(data)
+        if handler:
+            handler(update, context)
+            return
             
-        elif data.startswith('lang_'):
-            lang = data.split('_')[1]
-            user_data = db.get_user(user.id) or {}
-            user_data['language'] = lang
-            db.save_user(user.id, user_data)
+        match = _CALLBACK_RE.match(data)
+        if match:
+            self._callback_arg_handlers[match['op']](update, context, match['arg'])
             
-            query.edit_message_text(
-                f"Language changed to {'English' if lang == 'en' else 'Russian'}.",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("« Back", callback_data="back_to_main")]
-                ])
+    def _cb_back_to_main(self, update: Update, context: CallbackContext):
+        self.show_main_menu(update.callback_query)
+        
+    def _cb_post_preview(self, update: Update, context: CallbackContext):
+        self.cancel_post_preview(context.user_data)
+        self.show_post_preview(update, context.user_data, is_callback=True)
+        
+    def _cb_select_channel(self, update: Update, context: CallbackContext, arg: str):
+        channel_id = int(arg)
+        context.user_data['selected_channel'] = channel_id
+        context.user_data['creating_post'] = True
+        _creating_post_users.add(update.effective_user.id)
+        
+        channel = db.get_channel(channel_id)
+        if channel:
+            update.callback_query.edit_message_text(
+                f"📝 <b>Creating post for:</b> {channel.name}\n\n"
+                "Send me the content for your post. You can send:\n"
+                "• Text with formatting\n"
+                "• Photos with captions\n"
+                "• Videos with captions\n"
+                "• Documents\n\n"
+                "When finished, click 'Preview' below.",
+                parse_mode=ParseMode.HTML,
+                reply_markup=self.get_post_creation_keyboard()
             )
             
+    def _cb_lang(self, update: Update, context: CallbackContext, lang: str):
+        user = update.effective_user
+        user_data = db.get_user(user.id) or UserRecord(id=user.id)
+        user_data.language = lang
+        db.save_user(user.id, user_data)
+        
+        update.callback_query.edit_message_text(
+            f"Language changed to {'English' if lang == 'en' else 'Russian'}.",
+            reply_markup=_BACK_ONLY_MARKUP
+        )
+        
     def show_main_menu(self, query):
         """Show main menu."""
         query.edit_message_text(
@@ -489,169 +983,182 @@ Now you can:
         
     def get_main_menu_keyboard(self):
         """Get main menu inline keyboard."""
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("📝 Create Post", callback_data="create_post")],
-            [InlineKeyboardButton("📢 My Channels", callback_data="my_channels")],
-            [InlineKeyboardButton("⏰ Scheduled Posts", callback_data="scheduled_posts")],
-            [InlineKeyboardButton("📊 Statistics", callback_data="statistics")],
-            [InlineKeyboardButton("⚙️ Settings", callback_data="settings")],
-            [InlineKeyboardButton("❓ Help", callback_data="help")]
-        ])
+        return _MAIN_MENU_KB
         
     def get_post_creation_keyboard(self):
         """Get keyboard for post creation."""
-        return InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("📎 Add Media", callback_data="add_media"),
-                InlineKeyboardButton("🔗 Add Buttons", callback_data="add_buttons")
-            ],
-            [
-                InlineKeyboardButton("👀 Preview", callback_data="post_preview"),
-                InlineKeyboardButton("🗑 Clear All", callback_data="clear_post")
-            ],
-            [
-                InlineKeyboardButton("⏰ Schedule", callback_data="schedule_post"),
-                InlineKeyboardButton("📤 Send Now", callback_data="send_post")
-            ],
-            [InlineKeyboardButton("« Cancel", callback_data="back_to_main")]
-        ])
+        return _POST_CREATE_KB
+        
+    def schedule_post_preview(self, update: Update, context: CallbackContext):
+        """Coalesce previews for messages sent in quick succession into one."""
+        self.cancel_post_preview(context.user_data)
+        context.user_data['_preview_job'] = context.job_queue.run_once(
+            self._send_scheduled_preview,
+            PREVIEW_DEBOUNCE,
+            context=(update, context.user_data)
+        )
+        
+    def cancel_post_preview(self, user_data: Dict):
+        job = user_data.pop('_preview_job', None)
+        if job:
+            job.schedule_removal()
+            
+    def _send_scheduled_preview(self, context: CallbackContext):
+        update, user_data = context.job.context
+        user_data.pop('_preview_job', None)
+        self.show_post_preview(update, user_data)
+        
+    @staticmethod
+    def _format_preview_line(i: int, msg: Dict) -> Optional[str]:
+        if msg.get('text'):
+            text_preview = msg['text'][:100] + "..." if len(msg['text']) > 100 else msg['text']
+            return f"{i}. 📝 {text_preview}"
+        if msg.get('photo'):
+            return f"{i}. 📷 Photo with caption"
+        if msg.get('video'):
+            return f"{i}. 🎥 Video with caption"
+        if msg.get('document'):
+            return f"{i}. 📄 Document with caption"
+        return None
         
-    def show_post_preview(self, update: Update, context: CallbackContext, is_callback=False):
+    def show_post_preview(self, update: Update, user_data: Dict, is_callback=False):
         """Show preview of the post being created."""
-        post_messages = context.user_data.get('post_messages', [])
-        channel_id = context.user_data.get('selected_channel')
+        post_messages = user_data.get('post_messages', [])
+        channel_id = user_data.get('selected_channel')
         channel = db.get_channel(channel_id) if channel_id else None
         
         if not post_messages:
             text = "No content added yet. Send me messages to build your post."
             keyboard = self.get_post_creation_keyboard()
         else:
-            # Build preview text
-            preview_text = f"📋 <b>Post Preview</b>\n\n"
-            preview_text += f"<b>Channel:</b> {channel['name'] if channel else 'Not selected'}\n"
-            preview_text += f"<b>Messages:</b> {len(post_messages)}\n\n"
-            
-            # Show first 3 messages as preview
-            for i, msg in enumerate(post_messages[:3], 1):
-                if msg.get('text'):
-                    text_preview = msg['text'][:100] + "..." if len(msg['text']) > 100 else msg['text']
-                    preview_text += f"{i}. 📝 {text_preview}\n"
-                elif msg.get('photo'):
-                    preview_text += f"{i}. 📷 Photo with caption\n"
-                elif msg.get('video'):
-                    preview_text += f"{i}. 🎥 Video with caption\n"
-                elif msg.get('document'):
-                    preview_text += f"{i}. 📄 Document with caption\n"
-                    
+            # Build preview text, showing the first 3 messages
+            parts = [
+                "📋 <b>Post Preview</b>",
+                "",
+                f"<b>Channel:</b> {channel.name if channel else 'Not selected'}",
+                f"<b>Messages:</b> {len(post_messages)}",
+                ""
+            ]
+            parts.extend(filter(None, (
+                self._format_preview_line(i, msg)
+                for i, msg in enumerate(post_messages[:3], 1)
+            )))
+            
             if len(post_messages) > 3:
-                preview_text += f"\n... and {len(post_messages) - 3} more messages"
+                parts.append("")
+                parts.append(f"... and {len(post_messages) - 3} more messages")
                 
-            text = preview_text
+            text = "\n".join(parts)
             keyboard = self.get_post_creation_keyboard()
             
         if is_callback:
+            # Re-rendering an unchanged preview in place is a wasted request
+            rendered = (update.callback_query.message.message_id, len(post_messages))
+            if user_data.get('_last_preview') == rendered:
+                return
             update.callback_query.edit_message_text(
                 text,
                 parse_mode=ParseMode.HTML,
                 reply_markup=keyboard
             )
         else:
-            update.message.reply_text(
+            sent = update.message.reply_text(
                 text,
                 parse_mode=ParseMode.HTML,
                 reply_markup=keyboard
             )
+            rendered = (sent.message_id, len(post_messages))
+            
+        user_data['_last_preview'] = rendered
             
     def send_post_to_channel(self, update: Update, context: CallbackContext):
         """Send post to selected channel."""
         query = update.callback_query
         channel_id = context.user_data.get('selected_channel')
         channel = db.get_channel(channel_id)
-        post_messages = context.user_data.get('post_messages', [])
         
         if not channel:
             query.answer("Channel not found.", show_alert=True)
             return
             
+        # Get bot token for this channel
+        bot_token = channel.bot_token
+        if not bot_token:
+            query.answer(
+                "No bot connected to this channel. Please add a bot first.",
+                show_alert=True
+            )
+            return
+            
+        # Claim the post before sending: callbacks run concurrently, and a
+        # second "Send Now" tap must not send the same messages again
+        post_messages = context.user_data.pop('post_messages', None)
+            
         if not post_messages:
             query.answer("No content to send.", show_alert=True)
             return
             
         try:
-            # Get bot token for this channel
-            bot_token = channel.get('bot_token')
-            if not bot_token:
-                query.answer(
-                    "No bot connected to this channel. Please add a bot first.",
-                    show_alert=True
-                )
-                return
-                
-            # Create bot instance
-            channel_bot = TelegramBot(token=bot_token)
+            # Reuse the pooled bot instance for this token
+            channel_bot = _bot_for(bot_token)
             
-            # Send messages to channel with preserved formatting
+            # Send messages to channel with preserved formatting; runs of
+            # consecutive photos/videos go out as albums in a single request
             sent_messages = []
+            media_run = []
             for msg_data in post_messages:
-                if msg_data.get('photo'):
-                    sent_msg = channel_bot.send_photo(
-                        chat_id=channel_id,
-                        photo=msg_data['photo'],
-                        caption=msg_data.get('caption', ''),
-                        parse_mode=ParseMode.HTML,
-                        caption_entities=msg_data.get('caption_entities')
-                    )
-                elif msg_data.get('video'):
-                    sent_msg = channel_bot.send_video(
-                        chat_id=channel_id,
-                        video=msg_data['video'],
-                        caption=msg_data.get('caption', ''),
-                        parse_mode=ParseMode.HTML,
-                        caption_entities=msg_data.get('caption_entities')
-                    )
-                elif msg_data.get('text'):
-                    sent_msg = channel_bot.send_message(
+                if msg_data.get('photo') or msg_data.get('video'):
+                    media_run.append(msg_data)
+                    if len(media_run) == MEDIA_GROUP_MAX:
+                        sent_messages.extend(self.send_media_run(channel_bot, channel_id, media_run))
+                        media_run = []
+                    continue
+                    
+                if media_run:
+                    sent_messages.extend(self.send_media_run(channel_bot, channel_id, media_run))
+                    media_run = []
+                    
+                if msg_data.get('text'):
+                    sent_msg = _gated_send(
+                        channel_bot.send_message,
                         chat_id=channel_id,
                         text=msg_data['text'],
                         parse_mode=ParseMode.HTML,
                         entities=msg_data.get('entities')
                     )
-                else:
-                    continue
+                    sent_messages.append(sent_msg.message_id)
                     
-                sent_messages.append(sent_msg.message_id)
+            if media_run:
+                sent_messages.extend(self.send_media_run(channel_bot, channel_id, media_run))
                 
             # Store post data
-            post_id = f"{channel_id}_{datetime.now().timestamp()}"
-            post_data = {
-                'id': post_id,
-                'channel_id': channel_id,
-                'user_id': update.effective_user.id,
-                'messages': post_messages,
-                'sent_messages': sent_messages,
-                'sent_date': datetime.now().isoformat(),
-                'type': 'instant'
-            }
+            sent_at = datetime.now()
+            post_id = f"{channel_id}_{next(_post_seq)}"
+            post_data = PostRecord(
+                id=post_id,
+                channel_id=channel_id,
+                user_id=update.effective_user.id,
+                messages=post_messages,
+                sent_messages=sent_messages,
+                sent_date=sent_at.isoformat(),
+                type='instant'
+            )
             
-            db.posts[post_id] = post_data
+            db.save_post(post_id, post_data)
             
             # Send success message with reply functionality
-            success_text = f"""
-✅ <b>Post Successfully Sent!</b>
-
-<b>Channel:</b> {channel['name']}
-<b>Messages:</b> {len(sent_messages)}
-<b>Time:</b> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-
-You can now reply to this post directly in the channel.
-            """
+            success_text = LANG['posts']['sent'].format(
+                channel=channel.name,
+                count=len(sent_messages),
+                time=sent_at.strftime('%Y-%m-%d %H:%M:%S')
+            )
             
             # Create reply keyboard
             reply_keyboard = InlineKeyboardMarkup([
                 [
                     InlineKeyboardButton(
                         "👁 View in Channel",
-                        url=f"https://t.me/c/{str(channel_id)[4:]}/{sent_messages[0]}" if sent_messages else "#"
+                        url=f"https://t.me/c/{_internal_chat_id(channel_id)}/{sent_messages[0]}" if sent_messages else "#"
                     )
                 ],
                 [InlineKeyboardButton("📝 New Post", callback_data="create_post")],
@@ -665,14 +1172,56 @@ You can now reply to this post directly in the channel.
             )
             
             # Clear post data
-            context.user_data.pop('post_messages', None)
+            self.cancel_post_preview(context.user_data)
+            context.user_data.pop('_last_preview', None)
             context.user_data.pop('selected_channel', None)
             context.user_data.pop('creating_post', None)
+            _creating_post_users.discard(update.effective_user.id)
             
         except TelegramError as e:
-            logger.error(f"Error sending post: {e}")
+            # Hand the post back so the user can retry, ahead of anything
+            # they added while it was being sent
+            context.user_data['post_messages'] = post_messages + context.user_data.get('post_messages', [])
+            logger.error("Error sending post: %s", e)
             query.answer(f"Error sending post: {str(e)}", show_alert=True)
             
+    def send_media_run(self, channel_bot: TelegramBot, channel_id: int, media_run: List[Dict]) -> List[int]:
+        """Send consecutive photos/videos, as a media group when there are several."""
+        if len(media_run) == 1:
+            msg_data = media_run[0]
+            if msg_data.get('photo'):
+                sent_msg = _gated_send(
+                    channel_bot.send_photo,
+                    chat_id=channel_id,
+                    photo=msg_data['photo'],
+                    caption=msg_data.get('caption', ''),
+                    parse_mode=ParseMode.HTML,
+                    caption_entities=msg_data.get('caption_entities')
+                )
+            else:
+                sent_msg = _gated_send(
+                    channel_bot.send_video,
+                    chat_id=channel_id,
+                    video=msg_data['video'],
+                    caption=msg_data.get('caption', ''),
+                    parse_mode=ParseMode.HTML,
+                    caption_entities=msg_data.get('caption_entities')
+                )
+            return [sent_msg.message_id]
+            
+        media_group = []
+        for msg_data in media_run:
+            media_cls = InputMediaPhoto if msg_data.get('photo') else InputMediaVideo
+            media_group.append(media_cls(
+                msg_data.get('photo') or msg_data['video'],
+                caption=msg_data.get('caption', ''),
+                parse_mode=ParseMode.HTML,
+                caption_entities=msg_data.get('caption_entities')
+            ))
+            
+        sent = _gated_send(channel_bot.send_media_group, chat_id=channel_id, media=media_group)
+        return [m.message_id for m in sent]
+        
     def schedule_post(self, update: Update, context: CallbackContext):
         """Schedule a post for later delivery."""
         query = update.callback_query
@@ -687,17 +1236,7 @@ You can now reply to this post directly in the channel.
             "• <code>09:00 25.12.2023</code> - Dec 25, 2023 at 9:00 AM\n\n"
             "Or choose one of the quick options below:",
             parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("Today 09:00", callback_data="schedule_today_0900"),
-                    InlineKeyboardButton("Today 18:00", callback_data="schedule_today_1800")
-                ],
-                [
-                    InlineKeyboardButton("Tomorrow 09:00", callback_data="schedule_tomorrow_0900"),
-                    InlineKeyboardButton("Tomorrow 18:00", callback_data="schedule_tomorrow_1800")
-                ],
-                [InlineKeyboardButton("« Back", callback_data="post_preview")]
-            ])
+            reply_markup=_SCHEDULE_KB
         )
         
         context.user_data['scheduling_post'] = True
@@ -705,15 +1244,14 @@ You can now reply to this post directly in the channel.
         
     def error_handler(self, update: Update, context: CallbackContext):
         """Handle errors."""
-        logger.error(f"Update {update} caused error {context.error}")
+        logger.error("Update %s caused error %s", update, context.error)
         
         # Try to notify user about error
         try:
             if update and update.effective_message:
                 update.effective_message.reply_text(
                     "❌ An error occurred. Please try again.\n\n"
-                    "If the problem persists, contact @ControllerSupportBot",
-                    parse_mode=ParseMode.HTML
+                    "If the problem persists, contact @ControllerSupportBot"
                 )
         except:
             pass
@@ -721,7 +1259,31 @@ You can now reply to this post directly in the channel.
 class ReplyManager:
     """Manager for handling replies to channel posts."""
     
+    # Media kind -> Bot method; the kind doubles as the method's file parameter
+    # and the attribute holding the sent file on the returned Message
+    _SENDERS = {
+        'photo': 'send_photo',
+        'video': 'send_video',
+        'document': 'send_document',
+    }
+    
+    # Bot API writes for replies run here so handlers never block on Telegram
+    _send_pool = ThreadPoolExecutor(max_workers=REPLY_SEND_WORKERS, thread_name_prefix='reply-send')
+    
     @staticmethod
+    @lru_cache(maxsize=256)
+    def _senders_for(bot_token: str) -> Dict[str, Callable]:
+        """Reply send methods of a channel's bot with parse_mode=HTML pre-bound."""
+        bot = _bot_for(bot_token)
+        senders = {
+            kind: partial(getattr(bot, method), parse_mode=ParseMode.HTML)
+            for kind, method in ReplyManager._SENDERS.items()
+        }
+        senders['text'] = partial(bot.send_message, parse_mode=ParseMode.HTML)
+        return senders
+        
+    @staticmethod
+    @lru_cache(maxsize=4096)
     def create_reply_keyboard(channel_id: int, message_id: int):
         """Create inline keyboard for replying to a post."""
         return InlineKeyboardMarkup([
@@ -771,7 +1333,14 @@ class ReplyManager:
         )
         
     @staticmethod
-    def send_reply(context: CallbackContext, reply_data: Dict, original_message_id: int):
+    def send_reply(context: CallbackContext, reply_data: Dict, original_message_id: int) -> 'Future[bool]':
+        """Queue a reply to a channel post; the future resolves to whether it was sent."""
+        return ReplyManager._send_pool.submit(
+            ReplyManager._do_send_reply, context, reply_data, original_message_id
+        )
+        
+    @staticmethod
+    def _do_send_reply(context: CallbackContext, reply_data: Dict, original_message_id: int) -> bool:
         """Send reply to a channel post."""
         try:
             channel_id = reply_data['channel_id']
@@ -781,57 +1350,139 @@ class ReplyManager:
             
             # Get channel and bot
             channel = db.get_channel(channel_id)
-            if not channel or not channel.get('bot_token'):
+            if not channel or not channel.bot_token:
                 return False
                 
-            bot = TelegramBot(token=channel['bot_token'])
+            bot = _bot_for(channel.bot_token)
             
             # Send reply as a comment/reply to original message
-            if media:
-                # Handle media reply
-                if media.get('photo'):
-                    bot.send_photo(
-                        chat_id=channel_id,
-                        photo=media['photo'],
+            common = {'chat_id': channel_id, 'reply_to_message_id': original_message_id}
+            if media and media.get('photo') and media.get('video'):
+                # Photo and video together go out as one album, captioned on the first item
+                photo_key = _media_key(media['photo'])
+                video_key = _media_key(media['video'])
+                photo_id = db.get_file_id(channel.bot_token, photo_key) if photo_key else None
+                video_id = db.get_file_id(channel.bot_token, video_key) if video_key else None
+                sent = _send_with_retry(
+                    bot.send_media_group,
+                    media=[
+                        InputMediaPhoto(photo_id or _upload_input(media['photo']), caption=message_text, parse_mode=ParseMode.HTML),
+                        InputMediaVideo(video_id or _upload_input(media['video']))
+                    ],
+                    **common
+                )
+                if photo_key and not photo_id:
+                    db.save_file_id(channel.bot_token, photo_key, sent[0].photo[-1].file_id)
+                if video_key and not video_id:
+                    db.save_file_id(channel.bot_token, video_key, sent[1].video.file_id)
+            else:
+                # Single media reply: first matching kind wins, text-only otherwise
+                kind = next((k for k in ReplyManager._SENDERS if media and media.get(k)), None)
+                senders = ReplyManager._senders_for(channel.bot_token)
+                if kind:
+                    key = _media_key(media[kind])
+                    file_id = db.get_file_id(channel.bot_token, key) if key else None
+                    sent = _send_with_retry(
+                        senders[kind],
                         caption=message_text,
-                        reply_to_message_id=original_message_id,
-                        parse_mode=ParseMode.HTML
+                        **{kind: file_id or _upload_input(media[kind])},
+                        **common
                     )
-                elif media.get('video'):
-                    bot.send_video(
-                        chat_id=channel_id,
-                        video=media['video'],
-                        caption=message_text,
-                        reply_to_message_id=original_message_id,
-                        parse_mode=ParseMode.HTML
+                    if key and not file_id:
+                        sent_file = sent.photo[-1] if kind == 'photo' else getattr(sent, kind)
+                        db.save_file_id(channel.bot_token, key, sent_file.file_id)
+                else:
+                    _send_with_retry(
+                        senders['text'],
+                        text=message_text,
+                        **common
                     )
-            else:
-                # Text-only reply
-                bot.send_message(
-                    chat_id=channel_id,
-                    text=message_text,
-                    reply_to_message_id=original_message_id,
-                    parse_mode=ParseMode.HTML
-                )
-                
+                    
             return True
             
-        except Exception as e:
-            logger.error(f"Error sending reply: {e}")
+        except (BadRequest, Unauthorized) as e:
+            logger.error("Reply to %s rejected: %s", reply_data.get('channel_id'), e)
+            return False
+        except TelegramError as e:
+            logger.error("Error sending reply: %s", e)
+            return False
+        except Exception:
+            # Nobody may wait on the future, so don't leave the error in it
+            logger.exception("Unexpected error sending reply to %s", reply_data.get('channel_id'))
             return False
 
+def _start_log_listener() -> logging.handlers.QueueListener:
+    """Move the root logger's handlers behind a QueueHandler/QueueListener pair."""
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    log_queue = queue.Queue(-1)
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def _parse_cpu_list(spec: str) -> Set[int]:
+    """Parse a CPU list like "0-3,6" into a set of CPU numbers."""
+    cpus = set()
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
 # Main function
 def main():
     """Start the bot."""
     if not BOT_TOKEN:
         raise ValueError("BOT_TOKEN environment variable is required")
         
+    # Hand log records to a background thread so handlers never block on the sinks;
+    # registered first so it stops last and still sees shutdown-time records
+    listener = _start_log_listener()
+    atexit.register(listener.stop)
+    
+    # Keep the interpreter and its worker threads on one set of cores
+    if CPU_AFFINITY:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, _parse_cpu_list(CPU_AFFINITY))
+        else:
+            logger.warning("CPU_AFFINITY is set but not supported on this platform")
+            
     # Create and start bot
     bot = TelegramChannelBot(BOT_TOKEN)
     
+    # Flush queued replies on shutdown
+    atexit.register(ReplyManager._send_pool.shutdown, wait=True)
+    
     # Start the Bot
-    bot.updater.start_polling()
+    if USE_WEBHOOK:
+        if not WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL environment variable is required when USE_WEBHOOK is set")
+        # The webhook server runs tornado on an asyncio loop; uvloop is a
+        # faster drop-in for it (POSIX only)
+        if uvloop is not None and sys.platform != 'win32':
+            uvloop.install()
+        bot.updater.start_webhook(
+            listen='0.0.0.0',
+            port=PORT,
+            url_path=BOT_TOKEN,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{BOT_TOKEN}",
+            allowed_updates=ALLOWED_UPDATES
+        )
+    else:
+        bot.load_offset()
+        bot.updater.start_polling(timeout=30, allowed_updates=ALLOWED_UPDATES)
     bot.updater.idle()
+    
+    if not USE_WEBHOOK:
+        bot.save_offset()
 
 if __name__ == '__main__':
     main()